@@ -1,15 +1,36 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
+import atexit
+import hashlib
+import http.cookiejar
+import io
 import logging
 import logging.handlers
 import os
+import queue
 import re
 import time
-import requests
+import httpx
 import json
 import sys
 
+# Do not collect record details our log format does not use. Thread name
+# is in the format, so `logging.logThreads` stays enabled.
+logging.logProcesses = False
+logging.logMultiprocessing = False
+logging._srcfile = None  # skip stack walk looking for caller file and line
+
+# Login page is parsed in chunks of this size and we stop reading it after
+# this many chunks without new phone number
+SCAN_CHUNK_SIZE = 16 * 1024
+SCAN_IDLE_CHUNKS = 4
+
+# Session cookies are reused by runs that follow shortly after each other
+COOKIE_CACHE_DIR = os.path.expanduser("~/.cache/o2family")
+COOKIE_CACHE_TTL = 10 * 60
+
 
 def dir_path(path):
     if os.path.isdir(path):
@@ -18,9 +39,122 @@ def dir_path(path):
         raise argparse.ArgumentTypeError(f"Path {path} is not a valid directory")
 
 
+def numeric_id(value):
+    if re.fullmatch(r"[0-9]+", value):
+        return value
+    else:
+        raise argparse.ArgumentTypeError(f"ID {value} is not a number")
+
+
+def cookie_cache_file(username):
+    """
+    Path to cookie cache file specific for given user
+    """
+    digest = hashlib.sha256(username.encode()).hexdigest()[:16]
+    return os.path.join(COOKIE_CACHE_DIR, f"cookies-{digest}.json")
+
+
+def load_cookies(cookies, path, logger):
+    """
+    Load cookies stored by previous run if they are fresh enough, return
+    True if they were loaded. Broken cache is ignored, we just log in again.
+    """
+    try:
+        if time.time() - os.path.getmtime(path) > COOKIE_CACHE_TTL:
+            return False
+        with open(path, "r") as fp:
+            stored = json.load(fp)
+        for fields in stored:
+            fields["rest"] = fields.pop("_rest")
+            cookies.jar.set_cookie(http.cookiejar.Cookie(**fields))
+    except FileNotFoundError:
+        return False
+    except Exception as e:
+        logger.debug("Ignoring cookies from %s: %s", path, e)
+        cookies.jar.clear()
+        return False
+    return True
+
+
+def save_cookies(cookies, path):
+    """
+    Store cookies so following runs do not need to log in again
+    """
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as fp:
+        json.dump([vars(cookie) for cookie in cookies.jar], fp)
+
+
+def open_exclusive(path, force):
+    """
+    Create file and return its descriptor. If file exists, raise
+    FileExistsError or, with force, replace it.
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+    try:
+        return os.open(path, flags, 0o644)
+    except FileExistsError:
+        if not force:
+            raise
+        os.unlink(path)
+        return os.open(path, flags, 0o644)
+
+
+def write_file(path, content, force):
+    """
+    Store raw content to newly created file, see open_exclusive()
+    """
+    fd = open_exclusive(path, force)
+    # Buffered file object keeps writing until all of the content is written
+    with os.fdopen(fd, "wb") as fp:
+        fp.write(content)
+
+
+class LogFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    Rotating file handler that writes through a big buffer which is only
+    flushed when full, on rollover and on close. It also keeps track of file
+    size itself, so the common case does not need any syscall at all (stock
+    handler stats the file for every record, see
+    https://github.com/python/cpython/issues/105623)
+    """
+
+    buffer_size = 64 * 1024
+
+    def _open(self):
+        raw = open(self.baseFilename, self.mode + "b", buffering=0)
+        self._size = raw.seek(0, os.SEEK_END)
+        return io.TextIOWrapper(
+            io.BufferedWriter(raw, buffer_size=self.buffer_size),
+            encoding=self.encoding,
+            errors=self.errors,
+        )
+
+    def flush(self):
+        # Let the buffer fill up, closing the stream flushes it
+        pass
+
+    def shouldRollover(self, record):
+        if self.stream is None:  # delay was set...
+            self.stream = self._open()
+        if self.maxBytes > 0:
+            msg = "%s\n" % self.format(record)
+            msg_size = len(msg.encode(self.stream.encoding, self.stream.errors))
+            if self._size + msg_size >= self.maxBytes:
+                self._size = self.stream.tell()  # flushes, gives exact size
+                if super().shouldRollover(record):
+                    return True
+            self._size += msg_size
+        return False
+
+
 def setup_logger(stderr_log_lvl):
     """
     Create logger that logs to both stderr and log file but with different log levels
+
+    Records are only put to a queue by the logger, actual writing to stderr
+    and log file is done by a background thread.
     """
     # Remove all handlers from root logger if any
     logging.basicConfig(
@@ -34,59 +168,245 @@ def setup_logger(stderr_log_lvl):
         "%(asctime)s %(name)s %(threadName)s %(levelname)s %(message)s"
     )
     formatter.converter = time.gmtime
+    formatter.default_time_format = "%Y-%m-%dT%H:%M:%SZ"
+    formatter.default_msec_format = None
 
     # Add stderr handler, with provided level
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(formatter)
     console_handler.setLevel(stderr_log_lvl)
-    logging.getLogger().addHandler(console_handler)
 
     # Add file rotating handler, with level DEBUG
-    rotating_handler = logging.handlers.RotatingFileHandler(
+    rotating_handler = LogFileHandler(
         filename=f"/tmp/o2family_info.log", maxBytes=100 * 1000, backupCount=2
     )
     rotating_handler.setFormatter(formatter)
     rotating_handler.setLevel(logging.DEBUG)
-    logging.getLogger().addHandler(rotating_handler)
+
+    # Hand records over to the handlers in a background thread
+    log_queue = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(
+        log_queue, console_handler, rotating_handler, respect_handler_level=True
+    )
+    listener.start()
+    atexit.register(listener.stop)
+    logging.getLogger().addHandler(logging.handlers.QueueHandler(log_queue))
+
+    # HTTP client libraries log every request, header and frame on DEBUG
+    for name in ("httpx", "httpcore", "h2", "hpack"):
+        logging.getLogger(name).setLevel(logging.WARNING)
 
     return logging.getLogger("root")
 
 
-from html.parser import HTMLParser
-from html.entities import name2codepoint
-
-class MyHTMLParser(HTMLParser):
-    suspected = None
-    matches = {}
-
-    def handle_starttag(self, tag, attrs):
-        self.suspected = None
-        if tag == "a":
-            for attr in attrs:
-                if len(attr) != 2:
-                    continue
-                if attr[0] != "href":
-                    continue
-                if not attr[1].startswith("/nastaveni-tarifu-a-sluzeb/"):
-                    continue
-                if not attr[1].split("/")[2].isnumeric():
-                    continue
-                self.suspected = attr[1].split("/")[2]
-
-    def handle_endtag(self, tag):
-        self.suspected = None
-
-    def handle_data(self, data):
-        if self.suspected is None:
-            return
-        data_strip = data.strip()
-        if not data_strip.isnumeric():
-            return
-        self.matches[data_strip] = self.suspected
-        self.suspected = None
-
-
-def main():
+# Links to phone number settings look like
+# `<a href="/nastaveni-tarifu-a-sluzeb/<phone_id>/...">  <phone_number>  </a>`,
+# matched as loosely as HTMLParser would see them
+_HREF_PREFIX = b"/nastaveni-tarifu-a-sluzeb/"
+_ATTRS = rb"""(?:[^>"']|"[^"]*"|'[^']*')*"""  # quoted values may contain '>'
+_SPACE = rb"(?:\s|&nbsp;|&#160;|\xc2\xa0)*"  # including non-breaking space
+_PHONE_RE = re.compile(
+    rb"<a\b"
+    + _ATTRS
+    + rb"""?\bhref\s*=\s*["']?"""
+    + re.escape(_HREF_PREFIX)
+    + rb"""(\d+)(?:/[^"'\s>]*)?["']?"""
+    + _ATTRS
+    + rb">"
+    + _SPACE
+    + rb"(\d+)"
+    + _SPACE
+    + rb"(?=<)",
+    re.S | re.I,
+)
+
+# Like HTMLParser, do not look for links in comments and in script or style
+# content
+_SKIP_START_RE = re.compile(rb"(<!--)|<(script|style)\b[^>]*>", re.I)
+_SKIP_END_RES = {
+    None: re.compile(rb"-->"),
+    b"script": re.compile(rb"</script", re.I),
+    b"style": re.compile(rb"</style", re.I),
+}
+_SKIP_END_TAIL = len(b"</script") - 1
+
+# Login form, which we get back instead of dashboard when login fails
+_LOGIN_FORM_RE = re.compile(rb"""\bname\s*=\s*["']?_password\b""", re.I)
+_LOGIN_FORM_TAIL = 32
+
+# Unfinished tag at the end of a chunk we need to see completed
+_TAG_START_RE = re.compile(
+    rb"<(?:\Z|a(?:\Z|[\s>])|!-?-?\Z|(?:s|sc|scr|scri|scrip|st|sty|styl)\Z"
+    rb"|(?:script|style)(?:\Z|\s[^>]*\Z))",
+    re.I,
+)
+_MAX_TAIL = 4 * 1024  # no real tag is this long
+
+
+class PhoneIdScanner:
+    """
+    Collect phone numbers and their IDs from HTML that is fed chunk by chunk
+    """
+
+    def __init__(self):
+        self.matches = {}
+        self._buffer = b""
+        self._skip_end = None  # end of comment or script we are in
+
+    def feed(self, chunk):
+        buffer = self._buffer + chunk
+        pos = end = 0
+        while True:
+            if self._skip_end is not None:
+                m = self._skip_end.search(buffer, pos)
+                if m is None:
+                    # Only keep what might be start of the end marker
+                    self._buffer = buffer[max(pos, len(buffer) - _SKIP_END_TAIL) :]
+                    return
+                pos = end = m.end()
+                self._skip_end = None
+            skip = _SKIP_START_RE.search(buffer, pos)
+            # Include the '<' so number right before the comment is matched
+            endpos = skip.start() + 1 if skip else len(buffer)
+            # Plain substring search is much cheaper than running the regex
+            if buffer.find(_HREF_PREFIX, pos, endpos) != -1:
+                for m in _PHONE_RE.finditer(buffer, pos, endpos):
+                    self.matches[m.group(2).decode()] = m.group(1).decode()
+                    end = m.end()
+            if skip is None:
+                break
+            self._skip_end = _SKIP_END_RES[skip.group(2) and skip.group(2).lower()]
+            pos = end = skip.end()
+        # Only keep what might be start of a link (or of a comment or script)
+        # not yet complete, that is last tag if it is unfinished
+        keep = buffer.rfind(b"<", end)
+        if (
+            keep == -1
+            or not _TAG_START_RE.match(buffer, keep)
+            or len(buffer) - keep > _MAX_TAIL
+        ):
+            keep = len(buffer)
+        self._buffer = buffer[keep:]
+
+
+async def scan_phone_ids(response):
+    """
+    Parse phone number IDs from the page while it is being received
+
+    Phone numbers are listed together on the page, so once we found some and
+    next few chunks do not bring any new, rest of the page is not downloaded.
+    """
+    response.raise_for_status()
+    scanner = PhoneIdScanner()
+    idle_chunks = 0
+    async for chunk in response.aiter_bytes(SCAN_CHUNK_SIZE):
+        found = len(scanner.matches)
+        scanner.feed(chunk)
+        if found and len(scanner.matches) == found:
+            idle_chunks += 1
+            if idle_chunks >= SCAN_IDLE_CHUNKS:
+                break
+        else:
+            idle_chunks = 0
+    return scanner.matches
+
+
+async def is_login_page(response):
+    """
+    Check if page being received contains login form
+    """
+    tail = b""
+    async for chunk in response.aiter_bytes(SCAN_CHUNK_SIZE):
+        data = tail + chunk
+        if _LOGIN_FORM_RE.search(data):
+            return True
+        tail = data[-_LOGIN_FORM_TAIL:]
+    return False
+
+
+async def session_valid(client, phone_id):
+    """
+    Cheap check if session loaded from cache is still logged in, by asking
+    for info about given phone ID. Server might not support HEAD at all, so
+    this may give false negative, which only costs us one login.
+    """
+    response = await client.head(f"/api/tariff-info/{phone_id}", follow_redirects=False)
+    return response.is_success
+
+
+async def ensure_logged_in(client, data, cached, logger, phone_ids=None):
+    """
+    Get phone number IDs from the dashboard page, logging in only if session
+    loaded from cache (if any) is not valid. Return the IDs and True if we
+    had to log in, so new cookies should be stored. If login failed, return
+    None instead of the IDs.
+
+    If phone IDs are known already, dashboard page is not parsed at all and
+    IDs are used instead of phone numbers.
+    """
+    if phone_ids:
+        matches = {phone_id: phone_id for phone_id in phone_ids}
+        if cached:
+            if await session_valid(client, phone_ids[0]):
+                return matches, False
+            logger.debug("Session from previous run is not valid anymore")
+        # We do not need any IDs from the page, only check it is not the
+        # login form again, which is how failed login is answered
+        async with client.stream("POST", "/", data=data) as response:
+            response.raise_for_status()
+            if await is_login_page(response):
+                return None, False
+        return matches, True
+
+    if cached:
+        # Expired session is redirected to login page (or refused), do not
+        # even follow that and just log in again
+        async with client.stream("GET", "/", follow_redirects=False) as response:
+            if response.is_success:
+                matches = await scan_phone_ids(response)
+                if matches:
+                    return matches, False
+        logger.debug("Session from previous run is not valid anymore")
+
+    async with client.stream("POST", "/", data=data) as response:
+        matches = await scan_phone_ids(response)
+    # Failed login is answered with login page which lists no numbers
+    if not matches:
+        return None, False
+    return matches, True
+
+
+async def fetch(client, phone_number, phone_id, args, logger):
+    """
+    Get info about phone number and store it if requested, return False
+    if the output file could not be created
+    """
+    logger.info("Working on number %s id %s", phone_number, phone_id)
+    response = await client.get(
+        f"/api/tariff-info/{phone_id}", headers={"Accept": "application/json"}
+    )
+    response.raise_for_status()
+    content = response.content
+    payload = json.loads(content)  # make sure we got valid JSON
+    logger.debug("Received: %s", payload)
+
+    if args.save_as is None:
+        return True
+    save_as_file = os.path.join(args.save_as, f"{phone_number}.json")
+    try:
+        # Do not block other requests while writing to disk
+        await asyncio.to_thread(write_file, save_as_file, content, args.force)
+    except FileExistsError:
+        logger.error(
+            "File %s already exists. If you want to override it, use option '--force'",
+            save_as_file,
+        )
+        return False
+    logger.info("Dumped data to %s", save_as_file)
+    return True
+
+
+async def main():
     parser = argparse.ArgumentParser(
         description="Získá informace o O2Family čísle z jejich samoobsluhy",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -113,6 +433,12 @@ def main():
         action="store_true",
         help="Pokud soubor poskytnutý v '--save-as ...' existuje, přepiš ho",
     )
+    parser.add_argument(
+        "--id",
+        action="append",
+        type=numeric_id,
+        help="ID čísla ze samoobsluhy (z odkazu '/nastaveni-tarifu-a-sluzeb/<id>/'), lze zadat víckrát; čísla se pak nehledají na úvodní stránce a soubory se pojmenují '<id>.json'",
+    )
     parser.add_argument(
         "-v",
         "--verbose",
@@ -134,47 +460,58 @@ def main():
     else:
         logger = setup_logger(logging.WARNING)
 
-    logger.debug(f"Args: {args}")
+    logger.debug("Args: %s", args)
 
-    session = requests.Session()
     data = {
         "_username": args.username,
         "_password": args.password,
         "_logintype": "login",
     }
 
-    # Log in
-    response = session.post("https://moje.o2family.cz/", data=data)
-    response.raise_for_status()
-    logger.debug(f"Cookies after login: {session.cookies}")  # Expect to see PHPSESSID
-
-    # Parse phone number IDs
-    ###print(response.text)
-    parser = MyHTMLParser()
-    parser.feed(response.text)
-    for phone_number, phone_id in parser.matches.items():
-        logger.info(f"Working on number {phone_number} id {phone_id}")
-
-        # Get info about phone number
-        response = session.get(f"https://moje.o2family.cz/api/tariff-info/{phone_id}")
-        response.raise_for_status()
-        logger.debug(f"Received: {response.json()}")
-
-        if args.save_as is not None:
-            save_as_file = os.path.join(args.save_as, f"{phone_number}.json")
-            if os.path.exists(save_as_file):
-                if args.force:
-                    os.remove(save_as_file)
-                    logger.debug(f"Removed {save_as_file}")
-                else:
-                    logger.error(
-                        f"File {save_as_file} already exists. If you want to override it, use option '--force'"
-                    )
-                    return 1
-            with open(save_as_file, "w") as fp:
-                json.dump(response.json(), fp)
-                logger.info(f"Dumped data to {save_as_file}")
+    # Talk HTTP/2 so all the tariff-info calls are multiplexed as concurrent
+    # streams over one persistent TCP+TLS connection
+    limits = httpx.Limits(
+        max_connections=32, max_keepalive_connections=32, keepalive_expiry=60
+    )
+    async with httpx.AsyncClient(
+        http2=True,
+        base_url="https://moje.o2family.cz",
+        follow_redirects=True,
+        limits=limits,
+    ) as client:
+        # Reuse session from previous run if we have it
+        cookie_file = cookie_cache_file(args.username)
+        cached = load_cookies(client.cookies, cookie_file, logger)
+        if cached:
+            logger.debug("Loaded cookies from %s", cookie_file)
+
+        # Parse phone number IDs, logging in if needed
+        matches, relogged = await ensure_logged_in(
+            client, data, cached, logger, phone_ids=args.id
+        )
+        if matches is None:
+            logger.error("Login failed, check '--username' and '--password'")
+            return 1
+        if relogged:
+            logger.debug(
+                "Cookies after login: %s", list(client.cookies.jar)
+            )  # Expect to see PHPSESSID
+            try:
+                save_cookies(client.cookies, cookie_file)
+            except OSError as e:
+                logger.warning("Failed to store cookies to %s: %s", cookie_file, e)
+
+        # Get info about all phone numbers at once
+        tasks = [
+            fetch(client, phone_number, phone_id, args, logger)
+            for phone_number, phone_id in matches.items()
+        ]
+        results = await asyncio.gather(*tasks)
+
+    if not all(results):
+        return 1
+    return 0
 
 
 if __name__ == "__main__":
-    sys.exit(main() or 1)
+    sys.exit(asyncio.run(main()))